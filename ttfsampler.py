@@ -21,9 +21,13 @@ __version__ = "0.5"
 __revision__ = "$Id$"
 
 import sys
+import os
 import getopt
 import locale
 import logging
+import hashlib
+import multiprocessing
+import json
 
 from reportlab.pdfgen.canvas import Canvas
 from reportlab.pdfbase import pdfmetrics
@@ -35,17 +39,28 @@ VERBOSITY_1 = "<1>"
 VERBOSITY_2 = "<2>"
 VERBOSITY_3 = "<3>"
 
+# Bump this whenever thumbnail_drawing changes how a thumbnail looks, so that
+# thumbnails rendered by older versions are not mistaken for current ones.
+THUMBNAIL_LAYOUT = "1"
+
 def exit_usage():
-    print "Usage: %s [-fSv] [-s font-size] [-t text] -o output.pdf font.ttf..." % (sys.argv[0],)
+    print "Usage: %s [-fSv] [-s font-size] [-t text] [-r dpi] [-j workers] {-o output.pdf | -T thumbnail-dir} font.ttf..." % (sys.argv[0],)
     print """\
 Create a sample sheet from a list of TrueType fonts.
 
     -f      Skip broken or duplicate fonts rather than returning an error.
+    -j      Number of worker processes used to render thumbnails.  (Default:
+            the number of CPUs.)
+    -r      Resolution of the rendered thumbnails, in DPI.  (Default: 72)
     -S      Don't sort.  Fonts will be displayed in the order specified
             on the command line.
     -t      Specify text to render instead of the default of using the font
             name.  (When this option is enabled, the font name will be
             displayed before the rendered text.)
+    -T      Render one PNG thumbnail per font into the specified directory,
+            along with a manifest.json mapping face names to image files.
+            Thumbnails that already exist are not rendered again.  May be
+            used with or instead of -o.
     -v      Increase verbosity.
 """
     print "Version %s" % (__version__,)
@@ -62,10 +77,65 @@ class Config(object):
         self.top_margin = 1.0 * inch
         self.bottom_margin = 1.0 * inch
         self.specified_text = None
+        self.thumbnail_dir = None
+        self.thumbnail_dpi = 72.0
+        self.thumbnail_workers = None   # None means one per CPU
 
 class error(Exception):
     pass
 
+# Build a Drawing containing the same line that TTFSampler.render_line draws
+def thumbnail_drawing(font_id, font_size, face_name, specified_text):
+    from reportlab.graphics.shapes import Drawing, String
+
+    if specified_text is not None:
+        parts = [(font_id, specified_text), ("Times-Roman", u"  (%s)" % (face_name,))]
+    else:
+        parts = [(font_id, face_name)]
+
+    width = 0
+    ascent = descent = 0
+    for (font_name, s) in parts:
+        width += pdfmetrics.stringWidth(s, font_name, font_size)
+        (a, d) = pdfmetrics.getAscentDescent(font_name, font_size)
+        ascent = max(ascent, a)
+        descent = min(descent, d)
+
+    drawing = Drawing(max(width, 1), max(ascent - descent, 1))
+    x = 0
+    for (font_name, s) in parts:
+        drawing.add(String(x, -descent, s, fontName=font_name, fontSize=font_size))
+        x += pdfmetrics.stringWidth(s, font_name, font_size)
+    return drawing
+
+# Render a single thumbnail.  This runs in a worker process.  Returns a tuple
+# of (output_path, error_message), where error_message is None on success.
+def render_thumbnail(job):
+    from reportlab.graphics import renderPM
+
+    (font_id, ttf_filename, face_name, specified_text, font_size, dpi, output_path) = job
+
+    # Write to a temporary file first, so that an interrupted run doesn't
+    # leave a truncated image that would be skipped on the next run.
+    tmp_path = "%s.%d.tmp" % (output_path, os.getpid())
+    try:
+        # Forked workers inherit the fonts registered by the parent.
+        # Elsewhere (e.g. Windows), the font has to be loaded again in this
+        # process.
+        try:
+            pdfmetrics.getFont(font_id)
+        except KeyError:
+            pdfmetrics.registerFont(TTFont(font_id, ttf_filename))
+
+        drawing = thumbnail_drawing(font_id, font_size, face_name, specified_text)
+        renderPM.drawToFile(drawing, tmp_path, fmt='PNG', dpi=dpi)
+        os.rename(tmp_path, output_path)
+    except Exception, exc:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return (output_path, str(exc))
+    return (output_path, None)
+
 class TTFSampler(object):
     def __init__(self, config=None, log=None):
         if config is None:
@@ -94,8 +164,13 @@ class TTFSampler(object):
     def run(self):
         self.load_fonts()
         self.register_fonts()
-        self.render()
-        self.save()
+        if self.cfg.output_filename is not None:
+            self.render()
+            self.save()
+        if self.cfg.thumbnail_dir is not None:
+            self.render_thumbnails()
+        if self.skipped_fonts:
+            self.log.warning("skipped %d fonts" % (self.skipped_fonts,))
 
     def render_line(self, text, font_id, font_size, face_name):
         start_x = text.getX()
@@ -115,6 +190,7 @@ class TTFSampler(object):
     def load_fonts(self):
         self.log.debug(VERBOSITY_1 + "Loading fonts...")
         self.fonts = []
+        self.font_filenames = {}
         psfontnames = {}
         self.skipped_fonts = 0
         for i, ttf_filename in enumerate(self.cfg.input_filenames):
@@ -158,6 +234,7 @@ class TTFSampler(object):
 
             self.log.debug(VERBOSITY_3 + "  -> %r" % (face_name,))
             self.fonts.append((font_id, font, face_name))
+            self.font_filenames[font_id] = ttf_filename
 
         # Sort fonts by face_name
         if self.cfg.sort_fonts:
@@ -213,13 +290,138 @@ class TTFSampler(object):
             self.pdf.showPage()
             i += len(page_fonts)
 
-        if self.skipped_fonts:
-            self.log.warning("skipped %d fonts" % (self.skipped_fonts,))
-
     def save(self):
         self.log.debug(VERBOSITY_1 + "Writing %d pages (%d fonts) to %r" % (self.page_count, len(self.fonts), self.cfg.output_filename,))
         self.pdf.save()
 
+    def thumbnail_key(self, font_id, font):
+        # The key covers the font file's contents and every setting that
+        # affects the rendered image, so a thumbnail only needs to be
+        # rendered again when one of them changes.
+        h = hashlib.sha1()
+
+        # Hash the data TTFont already read, rather than reading the file
+        # again.  Fall back to reading the file if this version of ReportLab
+        # doesn't keep it around.
+        data = getattr(font.face, '_ttf_data', None)
+        if data is not None:
+            h.update(data)
+        else:
+            f = open(self.font_filenames[font_id], "rb")
+            try:
+                while True:
+                    data = f.read(65536)
+                    if not data:
+                        break
+                    h.update(data)
+            finally:
+                f.close()
+
+        h.update("\0%s\0%r\0%r\0%r" % (THUMBNAIL_LAYOUT, self.cfg.specified_text, self.cfg.font_size, self.cfg.thumbnail_dpi))
+        return h.hexdigest()
+
+    def render_thumbnail_jobs(self, jobs):
+        if self.cfg.thumbnail_workers == 1 or len(jobs) == 1:
+            return map(render_thumbnail, jobs)
+
+        pool = multiprocessing.Pool(self.cfg.thumbnail_workers)
+        try:
+            # On Python 2, waiting on a result without a timeout can't be
+            # interrupted by Ctrl-C, so use a (very long) timeout.
+            results = pool.map_async(render_thumbnail, jobs).get(365*86400)
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+        return results
+
+    def write_manifest(self, manifest_filename, manifest):
+        # Write to a temporary file first, so that readers never see a
+        # truncated manifest.
+        tmp_filename = "%s.%d.tmp" % (manifest_filename, os.getpid())
+        f = open(tmp_filename, "w")
+        try:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+            f.write("\n")
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(manifest_filename):
+            # Windows can't rename over an existing file.
+            os.remove(manifest_filename)
+        os.rename(tmp_filename, manifest_filename)
+
+    def render_thumbnails(self):
+        # Check up front that renderPM is available (the workers import it
+        # themselves).
+        try:
+            import reportlab.graphics.renderPM
+        except ImportError, exc:
+            msg = "can't render thumbnails: %s" % (str(exc),)
+            self.log.error(msg)
+            raise error(msg)
+        del reportlab
+
+        output_dir = self.cfg.thumbnail_dir
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        self.log.debug(VERBOSITY_1 + "Rendering %d thumbnails to %r ..." % (len(self.fonts), output_dir))
+        manifest = []
+        jobs = []
+        ttf_filenames = {}  # output_path -> ttf_filename
+        for (font_id, font, face_name) in self.fonts:
+            ttf_filename = self.font_filenames[font_id]
+            image_filename = self.thumbnail_key(font_id, font) + ".png"
+            output_path = os.path.join(output_dir, image_filename)
+
+            # Decode the filename to Unicode.  Try the filesystem encoding,
+            # and fall back to Latin-1
+            font_path = ttf_filename
+            if not isinstance(font_path, unicode):
+                try:
+                    font_path = font_path.decode(sys.getfilesystemencoding() or 'utf-8')
+                except UnicodeDecodeError:
+                    font_path = font_path.decode('latin1')
+
+            manifest.append({
+                'face': face_name,
+                'font': font_path,
+                'image': image_filename,
+            })
+            ttf_filenames[output_path] = ttf_filename
+            if os.path.exists(output_path):
+                self.log.debug(VERBOSITY_2 + "  Skipping font %r (unchanged)" % (face_name,))
+                continue
+            jobs.append((font_id, ttf_filename, face_name,
+                self.cfg.specified_text, self.cfg.font_size,
+                self.cfg.thumbnail_dpi, output_path))
+
+        self.thumbnail_count = 0
+        failed_paths = set()
+        if jobs:
+            for (output_path, exc_msg) in self.render_thumbnail_jobs(jobs):
+                if exc_msg is None:
+                    self.log.debug(VERBOSITY_2 + "  Wrote %r" % (output_path,))
+                    self.thumbnail_count += 1
+                    continue
+                ttf_filename = ttf_filenames[output_path]
+                if self.cfg.allow_broken_fonts:
+                    self.log.warning("skipping font %s: %s" % (ttf_filename, exc_msg))
+                    self.skipped_fonts += 1
+                    failed_paths.add(output_path)
+                else:
+                    msg = "can't render thumbnail for font %s: %s" % (ttf_filename, exc_msg)
+                    self.log.error(msg)
+                    raise error(msg)
+        manifest = [entry for entry in manifest
+            if os.path.join(output_dir, entry['image']) not in failed_paths]
+
+        manifest_filename = os.path.join(output_dir, "manifest.json")
+        self.log.debug(VERBOSITY_1 + "Writing %d thumbnails (%d fonts) and manifest to %r" % (self.thumbnail_count, len(manifest), manifest_filename))
+        self.write_manifest(manifest_filename, manifest)
+
 class CLILog(object):
     def __init__(self, config):
         self.cfg = config
@@ -255,7 +457,7 @@ class CLI(object):
 
         # Parse arguments
         try:
-            (options, arguments) = getopt.getopt(args, "vfSo:s:t:")
+            (options, arguments) = getopt.getopt(args, "vfSo:s:t:T:r:j:")
         except getopt.GetoptError, exc:
             self.log.error(str(exc))
             exit_usage()
@@ -273,13 +475,31 @@ class CLI(object):
                 self.cfg.sort_fonts = False
             elif opt == '-t':
                 self.cfg.specified_text = optarg.decode(locale.getpreferredencoding())
+            elif opt == '-T':
+                self.cfg.thumbnail_dir = optarg
+            elif opt == '-r':
+                try:
+                    self.cfg.thumbnail_dpi = float(optarg)
+                except ValueError:
+                    self.cfg.thumbnail_dpi = 0
+                if not self.cfg.thumbnail_dpi > 0:
+                    self.log.error("invalid DPI %r (must be greater than 0)" % (optarg,))
+                    exit_usage()
+            elif opt == '-j':
+                try:
+                    self.cfg.thumbnail_workers = int(optarg)
+                except ValueError:
+                    self.cfg.thumbnail_workers = 0
+                if self.cfg.thumbnail_workers < 1:
+                    self.log.error("invalid number of workers %r (must be at least 1)" % (optarg,))
+                    exit_usage()
             else:
                 raise AssertionErrror("BUG: unrecognized option %r" % (opt,))
         if not arguments:
             self.log.error("no font(s) specified")
             exit_usage()
-        if self.cfg.output_filename is None:
-            self.log.error("no output file specified")
+        if self.cfg.output_filename is None and self.cfg.thumbnail_dir is None:
+            self.log.error("no output file or thumbnail directory specified")
             exit_usage()
         self.cfg.input_filenames = arguments
 